@@ -4,15 +4,56 @@ Cloudflare Turnstile Challenge Solver using DrissionPage
 独立项目，用于解决 Cloudflare 验证并获取 cf_clearance cookie
 支持结果缓存
 """
+import os
 import time
+import queue
+import atexit
+import shutil
+import tempfile
 import json
 import random
+import signal
+import weakref
+import re
 import argparse
+import functools
+import logging
+import itertools
 import threading
 from typing import Optional, Dict
 from dataclasses import dataclass, field
 from datetime import datetime
 from collections import OrderedDict
+from urllib.parse import urlparse
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，缺失时回退到标准库 json
+    orjson = None
+
+# 日志由调用方配置：API 服务走队列异步输出，命令行在 main() 中输出到终端
+logger = logging.getLogger(__name__)
+
+
+# Cloudflare 验证页标题特征
+CHALLENGE_TITLES = ("just a moment", "checking", "please wait", "验证", "cloudflare", "attention")
+_CF_TITLE_RE = re.compile("|".join(map(re.escape, CHALLENGE_TITLES)), re.I)
+
+# 常见的 Chrome 版本和平台组合，导入时一次性生成全部 User-Agent
+_CHROME_VERSIONS = (
+    "120.0.0.0", "121.0.0.0", "122.0.0.0", "123.0.0.0", "124.0.0.0",
+    "125.0.0.0", "126.0.0.0", "127.0.0.0", "128.0.0.0", "129.0.0.0"
+)
+_PLATFORMS = (
+    "Windows NT 10.0; Win64; x64",
+    "Macintosh; Intel Mac OS X 10_15_7",
+    "X11; Linux x86_64",
+)
+USER_AGENTS = tuple(
+    f"Mozilla/5.0 ({platform}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{version} Safari/537.36"
+    for platform in _PLATFORMS
+    for version in _CHROME_VERSIONS
+)
 
 
 @dataclass
@@ -23,6 +64,10 @@ class CloudflareSolution:
     user_agent: str
     url: str = ""
     created_at: datetime = field(default_factory=datetime.now)
+    # 单调时钟时间戳，用于过期判断；created_at 只用于展示/序列化
+    created_at_mono: float = field(default_factory=time.monotonic, repr=False)
+    # API 服务缓存命中时复用的预编码响应前缀（由 server 首次命中时填充）
+    response_prefix: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
     
     def to_dict(self) -> dict:
         return {
@@ -35,103 +80,458 @@ class CloudflareSolution:
     
     def is_expired(self, max_age_seconds: int = 1800) -> bool:
         """检查 cookie 是否过期（默认30分钟）"""
-        age = (datetime.now() - self.created_at).total_seconds()
-        return age > max_age_seconds
+        return time.monotonic() - self.created_at_mono > max_age_seconds
+
+
+@functools.lru_cache(maxsize=256)
+def _domain(url: str) -> str:
+    """提取 URL 的域名部分（同一 URL 反复请求时跳过 urlparse）"""
+    parsed = urlparse(url)
+    return parsed.netloc or parsed.path
+
+
+def _origin(url: str) -> Optional[str]:
+    """URL 的源（scheme://host[:port]），非 http(s) 页面返回 None"""
+    parsed = urlparse(url)
+    if parsed.scheme in ("http", "https") and parsed.netloc:
+        return f"{parsed.scheme}://{parsed.netloc}"
+    return None
+
+
+class _AtomicCounter:
+    """
+    自增无锁的计数器。itertools.count 的 next() 在 C 层完成，不会被其他线程打断，
+    读取时用第二个计数器抵消读取本身消耗的那一次。
+    两个读取者交错执行时会互相多算/少算一次，所以读取串行化；读取只在统计接口里出现，锁不在热路径上
+    """
+    __slots__ = ("_incs", "_reads", "_read_lock")
+    
+    def __init__(self):
+        self._incs = itertools.count()
+        self._reads = itertools.count()
+        self._read_lock = threading.Lock()
+    
+    def inc(self):
+        next(self._incs)
+    
+    def value(self) -> int:
+        with self._read_lock:
+            return next(self._incs) - next(self._reads)
+
+
+class _CacheEntry:
+    """SolutionCache 内部条目"""
+    __slots__ = ("solution", "cost", "freq", "expires_at")
+    
+    def __init__(self, solution: CloudflareSolution, cost: int, expires_at: float):
+        self.solution = solution
+        self.cost = cost
+        self.freq = 0
+        # time.monotonic() 时间戳
+        self.expires_at = expires_at
+
+
+class _CacheShard:
+    """
+    SolutionCache 的一个分片：独立的 S3-FIFO 队列和锁
+    
+    三个 FIFO 队列：small(10%) 接纳新条目，main(90%) 存放被再次访问过的条目，
+    ghost 只记录最近从 small 淘汰的键。一次性访问的 URL 只会在 small 中短暂停留，
+    不会挤掉 main 中长期复用的条目。
+    """
+    
+    SWEEP_EVERY = 64
+    
+    def __init__(self, max_size: int, max_bytes: int):
+        self.small: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.main: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self.ghost: OrderedDict[str, bool] = OrderedDict()
+        self.max_size = max_size
+        self.small_size = max(1, max_size // 10)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # 条目数计数器，只在持有锁时修改，读取不加锁
+        self.size = 0
+        # 分片内最早的过期时间，当前时间早于它时无需逐条检查 TTL
+        self.earliest = float("inf")
+        self._sets_since_sweep = 0
+        self.lock = threading.Lock()
+    
+    def lookup(self, key: str) -> Optional[_CacheEntry]:
+        """无锁查找"""
+        return self.small.get(key) or self.main.get(key)
+    
+    def remove(self, key: str) -> Optional[_CacheEntry]:
+        """从 small/main 中移除条目（调用方持有锁）"""
+        entry = self.small.pop(key, None) or self.main.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.cost
+            self.size -= 1
+        return entry
+    
+    def _remember_ghost(self, key: str):
+        """记录被 small 淘汰的键（调用方持有锁）"""
+        self.ghost[key] = True
+        while len(self.ghost) > self.max_size:
+            self.ghost.popitem(last=False)
+    
+    def _evict_one(self):
+        """按 S3-FIFO 规则淘汰一个条目（调用方持有锁）"""
+        while True:
+            if self.small and (len(self.small) >= self.small_size or not self.main):
+                key, entry = self.small.popitem(last=False)
+                if entry.freq > 0:
+                    # 在 small 中被访问过，晋升到 main
+                    entry.freq = 0
+                    self.main[key] = entry
+                    continue
+                self._remember_ghost(key)
+            else:
+                key, entry = self.main.popitem(last=False)
+                if entry.freq > 0:
+                    # 再给一次机会，重新放回队尾
+                    entry.freq -= 1
+                    self.main[key] = entry
+                    continue
+            self.bytes -= entry.cost
+            self.size -= 1
+            return
+    
+    def insert(self, key: str, entry: _CacheEntry):
+        """写入条目（调用方持有锁）"""
+        # 如果已存在，先删除；保留访问频率，原本在 main 中的仍放回 main
+        in_main = False
+        old = self.small.pop(key, None)
+        if old is None:
+            old = self.main.pop(key, None)
+            in_main = old is not None
+        if old is not None:
+            self.bytes -= old.cost
+            self.size -= 1
+        
+        # 检查容量（条目数 + 字节数）
+        while self.size and (
+                self.size >= self.max_size
+                or self.bytes + entry.cost > self.max_bytes):
+            self._evict_one()
+        
+        if old is not None:
+            entry.freq = old.freq
+        if self.ghost.pop(key, False) or in_main:
+            # 原本在 main，或最近被淘汰过又回来了，说明值得长期保留
+            self.main[key] = entry
+        else:
+            self.small[key] = entry
+        self.bytes += entry.cost
+        self.size += 1
+        if entry.expires_at < self.earliest:
+            self.earliest = entry.expires_at
+        
+        self._sets_since_sweep += 1
+        if self._sets_since_sweep >= self.SWEEP_EVERY:
+            self.sweep()
+    
+    def sweep(self):
+        """清理已过期条目并重新计算 earliest（调用方持有锁）"""
+        self._sets_since_sweep = 0
+        now = time.monotonic()
+        expired = [key for queue in (self.small, self.main)
+                   for key, entry in queue.items() if entry.expires_at <= now]
+        for key in expired:
+            self.remove(key)
+        self.earliest = min(
+            (entry.expires_at for queue in (self.small, self.main) for entry in queue.values()),
+            default=float("inf"),
+        )
+    
+    def clear(self):
+        """清空分片（调用方持有锁）"""
+        self.small.clear()
+        self.main.clear()
+        self.ghost.clear()
+        self.bytes = 0
+        self.size = 0
+        self.earliest = float("inf")
 
 
 class SolutionCache:
     """
-    LRU 缓存，存储最近的 cf_clearance 结果
+    S3-FIFO 缓存，存储最近的 cf_clearance 结果
     支持按 URL+Proxy 键缓存，TTL 自动过期
+    按条目数和字节成本双重限制容量，避免少量超大 cookie 撑爆内存
+    
+    键按 hash 分布到 2 的幂个分片，写操作只锁所在分片。分片数会自动减半，
+    保证每个分片至少 MIN_SHARD_SIZE 个条目，否则 S3-FIFO 的 small/main 划分失去意义。
+    
+    TTL 按域名自适应：下游反馈 cookie 失效（invalidate）时，把该域名的 TTL
+    按 EWMA 向失效时的实际存活时间收缩；条目自然过期说明整个 TTL 内都可用，
+    TTL 逐步放大，最多回到配置值。
+    TTL_ALPHA 取 0.2，单次上报最多把 TTL 缩到原来的 0.8 倍：下游的一次误报
+    （网络抖动、IP 被风控）不会让 TTL 腰斩，而放大 1.1 倍/次只要两三次自然过期就能补回。
     """
     
-    def __init__(self, max_size: int = 50, ttl_seconds: int = 1800):
-        self._cache: OrderedDict[str, CloudflareSolution] = OrderedDict()
+    MAX_FREQ = 3
+    MIN_SHARD_SIZE = 16
+    TTL_ALPHA = 0.2
+    TTL_GROWTH = 1.1
+    MIN_TTL = 60
+    MAX_INVALIDATED = 1024
+    
+    def __init__(self, max_size: int = 50, ttl_seconds: int = 1800,
+                 max_bytes: int = 4 * 1024 * 1024, num_shards: int = 32):
+        while num_shards > 1 and max_size // num_shards < self.MIN_SHARD_SIZE:
+            num_shards //= 2
+        self._shards = tuple(
+            _CacheShard(-(-max_size // num_shards), max_bytes // num_shards)
+            for _ in range(num_shards)
+        )
+        self._shard_mask = num_shards - 1
         self._max_size = max_size
+        self._max_bytes = max_bytes
         self._ttl = ttl_seconds
-        self._lock = threading.Lock()
-        self._stats = {"hits": 0, "misses": 0}
+        # 各域名当前的自适应 TTL，没有记录的使用 _ttl
+        self._domain_ttl: Dict[str, float] = {}
+        # 各缓存键最近一次 invalidate 的时间（monotonic），浏览器池中在此之前保留的 cookie 不能再用
+        self._invalidated_at: OrderedDict[str, float] = OrderedDict()
+        self._invalidated_lock = threading.Lock()
+        # 命中统计，多线程并发自增不加锁也不丢计数
+        self._hits = _AtomicCounter()
+        self._misses = _AtomicCounter()
+    
+    @property
+    def ttl(self) -> int:
+        """配置的 TTL，也是自适应 TTL 的上限"""
+        return self._ttl
+    
+    @ttl.setter
+    def ttl(self, value: int):
+        self._ttl = value
+    
+    @staticmethod
+    def _cost(solution: CloudflareSolution) -> int:
+        """估算条目占用的字节数"""
+        cost = sum(len(k) + len(v) for k, v in solution.cookies.items())
+        return cost + len(solution.cf_clearance) + 256
     
     def _make_key(self, url: str, proxy: Optional[str] = None) -> str:
         """生成缓存键"""
-        from urllib.parse import urlparse
-        parsed = urlparse(url)
-        domain = parsed.netloc or parsed.path
-        return f"{domain}|{proxy or 'direct'}"
+        return f"{_domain(url)}|{proxy or 'direct'}"
+    
+    def _shard(self, key: str) -> _CacheShard:
+        return self._shards[hash(key) & self._shard_mask]
     
     def get(self, url: str, proxy: Optional[str] = None) -> Optional[CloudflareSolution]:
-        """获取缓存的解决方案"""
+        """
+        获取缓存的解决方案
+        读路径不加锁：单次 dict 查找在 CPython 中是原子的，S3-FIFO 命中时只需
+        累加访问频率，不需要调整队列顺序。只有清理过期条目时才尝试加锁，
+        锁被占用就跳过，留给后续淘汰处理。
+        """
         key = self._make_key(url, proxy)
+        shard = self._shard(key)
         
-        with self._lock:
-            if key not in self._cache:
-                self._stats["misses"] += 1
-                return None
-            
-            solution = self._cache[key]
-            
-            # 检查是否过期
-            if solution.is_expired(self._ttl):
-                del self._cache[key]
-                self._stats["misses"] += 1
-                return None
-            
-            # LRU: 移到末尾
-            self._cache.move_to_end(key)
-            self._stats["hits"] += 1
-            return solution
+        entry = shard.lookup(key)
+        if entry is None:
+            self._misses.inc()
+            return None
+        
+        # 检查是否过期：当前时间早于分片内最早过期时间时，不可能有条目过期
+        now = time.monotonic()
+        if now >= shard.earliest and now >= entry.expires_at:
+            if shard.lock.acquire(blocking=False):
+                try:
+                    if shard.lookup(key) is entry:
+                        shard.remove(key)
+                        self._grow_ttl(_domain(url))
+                finally:
+                    shard.lock.release()
+            self._misses.inc()
+            return None
+        
+        # 频率位允许偶发的丢失更新
+        entry.freq = min(entry.freq + 1, self.MAX_FREQ)
+        self._hits.inc()
+        return entry.solution
     
-    def set(self, url: str, solution: CloudflareSolution, proxy: Optional[str] = None):
-        """存储解决方案"""
+    def key_for(self, url: str, proxy: Optional[str] = None) -> str:
+        """缓存键（外部持久化层与本缓存使用同一个键）"""
+        return self._make_key(url, proxy)
+    
+    def set(self, url: str, solution: CloudflareSolution, proxy: Optional[str] = None, ttl: Optional[float] = None):
+        """存储解决方案；ttl 为空时使用该域名当前的 TTL"""
         key = self._make_key(url, proxy)
+        shard = self._shard(key)
         solution.url = url
+        cost = self._cost(solution)
+        if cost > shard.max_bytes:
+            # 单条超过分片预算，不缓存；同一键的旧条目也要删掉，否则 get 仍会返回被替换的旧结果
+            with shard.lock:
+                shard.remove(key)
+            return
         
-        with self._lock:
-            # 如果已存在，先删除
-            if key in self._cache:
-                del self._cache[key]
-            
-            # 检查容量
-            while len(self._cache) >= self._max_size:
-                self._cache.popitem(last=False)
-            
-            self._cache[key] = solution
+        with shard.lock:
+            shard.insert(key, _CacheEntry(solution, cost, time.monotonic() + (self.ttl_for(url) if ttl is None else ttl)))
+    
+    def ttl_for(self, url: str) -> float:
+        """域名当前的 TTL（秒）"""
+        return self._domain_ttl.get(_domain(url), self._ttl)
+    
+    def _grow_ttl(self, domain: str):
+        """条目自然过期：放大 TTL，不超过配置值"""
+        ttl = self._domain_ttl.get(domain)
+        if ttl is not None:
+            ttl = ttl * self.TTL_GROWTH
+            if ttl >= self._ttl:
+                self._domain_ttl.pop(domain, None)
+            else:
+                self._domain_ttl[domain] = ttl
     
     def invalidate(self, url: str, proxy: Optional[str] = None):
-        """使缓存失效"""
+        """
+        使缓存失效（下游发现 cookie 已被拒绝时调用），并据此收缩该域名的 TTL；
+        同时记下失效时间，之后的验证会先清掉浏览器里保留的旧 cookie
+        """
         key = self._make_key(url, proxy)
-        with self._lock:
-            self._cache.pop(key, None)
+        with self._invalidated_lock:
+            self._invalidated_at[key] = time.monotonic()
+            self._invalidated_at.move_to_end(key)
+            if len(self._invalidated_at) > self.MAX_INVALIDATED:
+                self._invalidated_at.popitem(last=False)
+        
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.remove(key)
+        if entry is None:
+            return
+        
+        domain = _domain(url)
+        age = time.monotonic() - entry.solution.created_at_mono
+        ttl = self._domain_ttl.get(domain, self._ttl)
+        if age < ttl:
+            ttl = self.TTL_ALPHA * age + (1 - self.TTL_ALPHA) * ttl
+            self._domain_ttl[domain] = max(self.MIN_TTL, ttl)
+    
+    def invalidated_at(self, url: str, proxy: Optional[str] = None) -> float:
+        """最近一次 invalidate 的时间（monotonic），没有记录时为 0"""
+        return self._invalidated_at.get(self._make_key(url, proxy), 0.0)
     
     def clear(self):
         """清空缓存"""
-        with self._lock:
-            self._cache.clear()
+        for shard in self._shards:
+            with shard.lock:
+                shard.clear()
     
     def stats(self) -> dict:
-        """获取缓存统计"""
-        with self._lock:
-            total = self._stats["hits"] + self._stats["misses"]
-            hit_rate = self._stats["hits"] / total if total > 0 else 0
-            return {
-                "size": len(self._cache),
-                "max_size": self._max_size,
-                "hits": self._stats["hits"],
-                "misses": self._stats["misses"],
-                "hit_rate": f"{hit_rate:.1%}"
-            }
+        """
+        获取缓存统计
+        全程不加锁，轮询统计不会阻塞 get/set；各分片的计数分别读取，
+        并发写入时 size/bytes 只是近似值。
+        """
+        size = sum(shard.size for shard in self._shards)
+        used_bytes = sum(shard.bytes for shard in self._shards)
+        hits, misses = self._hits.value(), self._misses.value()
+        total = hits + misses
+        hit_rate = hits / total if total > 0 else 0
+        return {
+            "size": size,
+            "max_size": self._max_size,
+            "bytes": used_bytes,
+            "max_bytes": self._max_bytes,
+            "shards": len(self._shards),
+            "adaptive_ttl": {domain: round(ttl) for domain, ttl in self._domain_ttl.items()},
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": f"{hit_rate:.1%}"
+        }
+
+
+def _kill_pid(pid: int):
+    """结束 Chromium 主进程：先 SIGTERM，0.5 秒后 SIGKILL"""
+    try:
+        os.kill(pid, signal.SIGTERM)
+        time.sleep(0.5)
+        os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+# 浏览器用户目录池：用完清掉 cookie/存储后复用，避免临时目录无限增长
+_user_data_dirs: "queue.LifoQueue[str]" = queue.LifoQueue()
+_all_user_data_dirs = set()
+_user_data_dirs_lock = threading.Lock()
+# 每次归还时清理的会话数据（相对用户目录）
+_SESSION_DATA_PATHS = (
+    "Default/Cookies", "Default/Cookies-journal",
+    "Default/Network/Cookies", "Default/Network/Cookies-journal",
+    "Default/Local Storage", "Default/Session Storage", "Default/IndexedDB",
+)
+
+
+def _acquire_user_data_dir() -> str:
+    """取一个空闲的浏览器用户目录，没有则新建"""
+    try:
+        return _user_data_dirs.get_nowait()
+    except queue.Empty:
+        path = tempfile.mkdtemp(prefix="cf_solver_")
+        with _user_data_dirs_lock:
+            _all_user_data_dirs.add(path)
+        return path
+
+
+def _release_user_data_dir(path: str, reuse: bool = True):
+    """归还用户目录；浏览器异常退出时目录可能仍被占用，直接删除"""
+    if reuse:
+        for rel in _SESSION_DATA_PATHS:
+            target = os.path.join(path, rel)
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.exists(target):
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+        _user_data_dirs.put(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        with _user_data_dirs_lock:
+            _all_user_data_dirs.discard(path)
 
 
-# 全局实例
-_solution_cache: Optional[SolutionCache] = None
+@atexit.register
+def _cleanup_user_data_dirs():
+    """进程退出时删除所有用户目录"""
+    with _user_data_dirs_lock:
+        for path in _all_user_data_dirs:
+            shutil.rmtree(path, ignore_errors=True)
+        _all_user_data_dirs.clear()
 
 
+def _close_page(page):
+    """关闭浏览器，失败时直接结束进程"""
+    finalizer = getattr(page, "_cf_finalizer", None)
+    try:
+        page.quit()
+        logger.info("  🔒 浏览器已关闭")
+    except Exception as e:
+        logger.warning("  ⚠️ 关闭浏览器失败，强制结束进程: %s", e)
+        if finalizer:
+            finalizer()
+        user_data_dir = getattr(page, "_cf_user_data_dir", None)
+        if user_data_dir:
+            _release_user_data_dir(user_data_dir, reuse=False)
+        return
+    # 正常退出后取消兜底，防止 PID 被复用后误杀
+    if finalizer:
+        finalizer.detach()
+    user_data_dir = getattr(page, "_cf_user_data_dir", None)
+    if user_data_dir:
+        _release_user_data_dir(user_data_dir)
+
+
+@functools.lru_cache(maxsize=1)
 def get_cache() -> SolutionCache:
-    """获取全局缓存实例"""
-    global _solution_cache
-    if _solution_cache is None:
-        _solution_cache = SolutionCache()
-    return _solution_cache
+    """获取全局缓存实例（由 lru_cache 持有单例）"""
+    return SolutionCache()
 
 
 class CloudflareSolver:
@@ -151,49 +551,13 @@ class CloudflareSolver:
         self.headless = headless
         self.timeout = timeout
         self.use_cache = use_cache
-        self._instance_counter = 0
     
     def _get_random_user_agent(self) -> str:
         """生成随机 User-Agent"""
-        # 常见的 Chrome 版本和平台组合
-        chrome_versions = [
-            "120.0.0.0", "121.0.0.0", "122.0.0.0", "123.0.0.0", "124.0.0.0",
-            "125.0.0.0", "126.0.0.0", "127.0.0.0", "128.0.0.0", "129.0.0.0"
-        ]
-        platforms = [
-            ("Windows NT 10.0; Win64; x64", "Windows"),
-            ("Macintosh; Intel Mac OS X 10_15_7", "macOS"),
-            ("X11; Linux x86_64", "Linux"),
-        ]
-        
-        chrome_ver = random.choice(chrome_versions)
-        platform, _ = random.choice(platforms)
-        
-        return f"Mozilla/5.0 ({platform}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{chrome_ver} Safari/537.36"
-    
-    def _random_delay(self, min_ms: int = 100, max_ms: int = 500):
-        """随机延迟"""
-        time.sleep(random.randint(min_ms, max_ms) / 1000)
-    
-    def _quick_check_cookie(self, page) -> Optional[str]:
-        """快速检查 cf_clearance cookie，必须页面已通过验证"""
-        try:
-            title = (page.title or "").lower()
-            # 如果还在验证页面，不返回 cookie
-            if any(t in title for t in ["just a moment", "checking", "please wait", "验证", "cloudflare"]):
-                return None
-            # 页面已加载，检查 cookie
-            for cookie in page.cookies():
-                if cookie["name"] == "cf_clearance":
-                    return cookie["value"]
-        except:
-            pass
-        return None
+        return random.choice(USER_AGENTS)
     
     def _create_page(self):
         """创建浏览器页面"""
-        import os
-        import tempfile
         from DrissionPage import ChromiumPage, ChromiumOptions
         
         options = ChromiumOptions()
@@ -204,9 +568,8 @@ class CloudflareSolver:
         elif os.path.exists(r"C:\Program Files\Google\Chrome\Application\chrome.exe"):
             options.set_browser_path(r"C:\Program Files\Google\Chrome\Application\chrome.exe")
         
-        # 每个实例独立用户目录，避免冲突
-        self._instance_counter += 1
-        user_data_dir = os.path.join(tempfile.gettempdir(), f"cf_solver_{self._instance_counter}_{random.randint(10000,99999)}")
+        # 每个浏览器独占一个用户目录，避免冲突；目录从池中复用
+        user_data_dir = _acquire_user_data_dir()
         options.set_user_data_path(user_data_dir)
         options.auto_port()
         
@@ -234,135 +597,170 @@ class CloudflareSolver:
             options.set_argument("--disable-dev-shm-usage")
             options.set_argument("--disable-gpu")
         
-        return ChromiumPage(options, timeout=30)
+        try:
+            page = ChromiumPage(options, timeout=30)
+        except Exception:
+            _release_user_data_dir(user_data_dir, reuse=False)
+            raise
+        page._cf_user_data_dir = user_data_dir
+        # navigator.userAgent 就是启动参数里的 UA，记下来省掉一次 run_js
+        page._cf_user_agent = fake_ua
+        
+        # 页面对象被回收（或 quit 失败）时兜底结束 Chromium 进程，避免僵尸进程累积；
+        # 进程退出时不逐个执行（每个要等 0.5 秒），由 BrowserPool.close 统一关闭
+        pid = page.browser.process_id
+        if pid:
+            page._cf_finalizer = weakref.finalize(page, _kill_pid, pid)
+            page._cf_finalizer.atexit = False
+        return page
     
-    def solve(self, website_url: str, skip_cache: bool = False, max_retries: int = 0) -> CloudflareSolution:
+    def solve(
+        self,
+        website_url: str,
+        skip_cache: bool = False,
+        max_retries: int = 0,
+        cancel_event: Optional[threading.Event] = None
+    ) -> CloudflareSolution:
         """
         解决 Cloudflare Turnstile challenge.
-        从浏览器池获取浏览器，用完关闭，池子异步补充新的。
+        从浏览器池获取浏览器，成功后放回池中复用；失败的浏览器直接关闭，重试时换新的。
+        cancel_event 被置位后（如客户端已断开）尽快放弃，释放浏览器。
         """
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        
         # 检查缓存
         if self.use_cache and not skip_cache:
             cache = get_cache()
             cached = cache.get(website_url, self.proxy)
             if cached:
-                print(f"📦 使用缓存的 cf_clearance")
+                logger.info("📦 使用缓存的 cf_clearance")
                 return cached
         
         last_error = None
-        print(f"🚀 开始获取 cf_clearance, URL: {website_url}")
+        logger.info("🚀 开始获取 cf_clearance, URL: %s", website_url)
+        
+        pool = get_browser_pool()
+        state_after = time.monotonic() if skip_cache else get_cache().invalidated_at(website_url, self.proxy)
         
         for attempt in range(max_retries + 1):
             page = None
+            solved = False
             
             try:
                 if attempt > 0:
-                    wait_time = random.randint(2000, 3000)
-                    print(f"🔄 第 {attempt}/{max_retries} 次重试，等待 {wait_time/1000:.1f}s...")
-                    self._random_delay(wait_time, wait_time + 1000)
+                    wait_time = random.uniform(2.0, 3.0)
+                    logger.info("🔄 第 %s/%s 次重试，等待 %.1fs...", attempt, max_retries, wait_time)
+                    cancel_event.wait(wait_time)
                 
-                # 每次创建新的浏览器
-                print(f"  📂 创建浏览器...")
-                page = self._create_page()
+                if cancel_event.is_set():
+                    logger.info("  🚫 请求已取消")
+                    raise CloudflareError("请求已取消")
                 
-                print(f"  ✓ 浏览器已就绪")
-                print(f"  🌐 访问: {website_url}")
+                logger.info("  📂 获取浏览器...")
+                # 强制刷新时、或该站点 cookie 被下游上报失效后，不沿用浏览器里更早保留的 cookie
+                page = pool.acquire(self.proxy, self.headless, state_after=state_after)
+                
+                logger.info("  ✓ 浏览器已就绪")
+                logger.info("  🌐 访问: %s", website_url)
                 
                 # 设置页面加载
+                origin = _origin(website_url)
+                if origin:
+                    page._cf_origins.add(origin)
                 try:
                     page.get(website_url, timeout=20)
                 except Exception as e:
-                    print(f"  ⚠️ 页面加载异常: {e}")
+                    logger.warning("  ⚠️ 页面加载异常: %s", e)
                 
-                # 立即检查是否已有 cf_clearance
-                cf_clearance = self._quick_check_cookie(page)
-                if cf_clearance:
-                    cookies = {cookie["name"]: cookie["value"] for cookie in page.cookies()}
-                    user_agent = page.run_js("return navigator.userAgent")
-                    solution = CloudflareSolution(
-                        cf_clearance=cf_clearance,
-                        cookies=cookies,
-                        user_agent=user_agent,
-                        url=website_url
-                    )
-                    if self.use_cache:
-                        get_cache().set(website_url, solution, self.proxy)
-                    print(f"✅ 快速获取 cf_clearance!")
-                    return solution
-                
-                # 等待 CF 验证
-                print(f"  ⏳ 等待验证...")
-                cf_clearance = self._check_clearance(page)
+                # 等待 CF 验证（第一次检查立即进行，已放行的页面不用等）
+                logger.info("  ⏳ 等待验证...")
+                cookies = self._poll_for_clearance(page, cancel_event=cancel_event)
                 
-                if cf_clearance:
-                    cookies = {cookie["name"]: cookie["value"] for cookie in page.cookies()}
-                    user_agent = page.run_js("return navigator.userAgent")
-                    
+                if cookies:
                     solution = CloudflareSolution(
-                        cf_clearance=cf_clearance,
+                        cf_clearance=cookies["cf_clearance"],
                         cookies=cookies,
-                        user_agent=user_agent,
+                        user_agent=page._cf_user_agent,
                         url=website_url
                     )
                     
                     if self.use_cache:
                         get_cache().set(website_url, solution, self.proxy)
                     
-                    print(f"✅ 成功获取 cf_clearance!")
+                    logger.info("✅ 成功获取 cf_clearance!")
+                    solved = True
                     return solution
                 else:
-                    print(f"  ❌ 未获取到 cf_clearance")
+                    logger.warning("  ❌ 未获取到 cf_clearance")
                     raise CloudflareError("需要人机验证或超时")
                 
             except Exception as e:
                 last_error = e
-                print(f"  ❌ 本次尝试失败: {e}")
+                logger.warning("  ❌ 本次尝试失败: %s", e)
+                if cancel_event.is_set():
+                    break
             finally:
-                # 关闭浏览器
+                # 成功的浏览器放回池中，失败的关闭
                 if page:
-                    try:
-                        page.quit()
-                        print(f"  🔒 浏览器已关闭")
-                    except:
-                        pass
+                    pool.release(page, healthy=solved)
                     page = None
         
-        print(f"❌ 所有 {max_retries + 1} 次尝试均失败")
+        if cancel_event.is_set():
+            raise CloudflareError("请求已取消")
+        
+        logger.warning("❌ 所有 %s 次尝试均失败", max_retries + 1)
         raise CloudflareError(f"重试 {max_retries} 次后仍然失败: {last_error}")
     
-    def _check_clearance(self, page, wait_time: int = 6) -> Optional[str]:
-        """检查是否获取到 cf_clearance，必须页面已通过验证"""
+    def _poll_for_clearance(
+        self,
+        page,
+        wait_time: int = 6,
+        cancel_event: Optional[threading.Event] = None
+    ) -> Optional[Dict[str, str]]:
+        """
+        轮询直到页面通过验证并拿到 cf_clearance，返回包含 cf_clearance 的 cookie 字典
+        第一次检查不等待，页面已放行时立即返回；每轮只在离开验证页后才读取一次 cookies
+        cancel_event 被置位时立即放弃
+        """
+        if cancel_event is None:
+            cancel_event = threading.Event()
         start_time = time.time()
         check_count = 0
-        cf_challenge_titles = ["just a moment", "checking", "please wait", "验证", "cloudflare", "attention"]
+        # 标题一旦离开验证页就不会再回去，之后不再读取标题；
+        # 导航完成前的空标题、about:blank 不算离开验证页
+        past_challenge = False
         
-        while time.time() - start_time < wait_time:
+        while True:
             check_count += 1
             elapsed = time.time() - start_time
             
             try:
-                title = (page.title or "").lower()
-                is_challenge_page = any(t in title for t in cf_challenge_titles)
+                if not past_challenge:
+                    title = page.title or ""
+                    past_challenge = (
+                        bool(title) and not _CF_TITLE_RE.search(title)
+                        and page.url.startswith(("http://", "https://"))
+                    )
                 
                 # 只有不在验证页面时才检查 cookie
-                if not is_challenge_page:
-                    for cookie in page.cookies():
-                        if cookie["name"] == "cf_clearance":
-                            print(f"    ✓ 验证通过，获取 cf_clearance ({elapsed:.1f}s)")
-                            return cookie["value"]
+                if past_challenge:
+                    cookies = {cookie["name"]: cookie["value"] for cookie in page.cookies()}
+                    if "cf_clearance" in cookies:
+                        logger.info("    ✓ 验证通过，获取 cf_clearance (%.1fs)", elapsed)
+                        return cookies
                     
                     # 页面已加载但没有 cookie，可能不需要 CF 验证
                     if check_count > 5:
-                        print(f"    ⚠️ 页面已加载但无 cf_clearance")
+                        logger.warning("    ⚠️ 页面已加载但无 cf_clearance")
                         return None
                 
             except Exception as e:
                 if check_count == 1:
-                    print(f"    ⚠️ 检查出错: {e}")
+                    logger.warning("    ⚠️ 检查出错: %s", e)
             
-            time.sleep(0.3)
-        
-        return None
+            if elapsed >= wait_time or cancel_event.wait(0.3):
+                return None
 
 
 class CloudflareError(Exception):
@@ -370,6 +768,192 @@ class CloudflareError(Exception):
     pass
 
 
+class BrowserPool:
+    """
+    浏览器池
+    按 (代理, 无头模式) 分组保存空闲浏览器。解题成功后清掉 HTTP 缓存和 sessionStorage 放回池中，
+    下次直接复用，省掉 Chromium 冷启动；解题失败的浏览器直接关闭，
+    预热过的分组会在后台补一个新的，不阻塞请求。
+    每个浏览器最多使用 max_uses 次，到达后关闭换新，避免 Chromium 内存持续增长。
+    代理很多时分组也多，所有分组的空闲浏览器总数不超过 max_idle。
+    cookie 和 localStorage 保留 state_ttl 秒，期间再访问同一站点时 Cloudflare 往往直接放行，
+    不用重新做验证；超过后下次归还时清空。acquire 时保留的状态早于 state_after 也会先清空
+    （强制刷新或 cookie 已被上报失效）。
+    """
+    
+    def __init__(self, size: int = 2, max_uses: int = 50, max_idle: int = 4, state_ttl: int = 1200):
+        # 每个分组最多保留的空闲浏览器数
+        self.size = size
+        # 所有分组合计最多保留的空闲浏览器数
+        self.max_idle = max_idle
+        # 单个浏览器的最大使用次数，0 表示不限制
+        self.max_uses = max_uses
+        # cookie/localStorage 保留秒数，0 表示每次归还都清空
+        self.state_ttl = state_ttl
+        self._idle: Dict[tuple, queue.LifoQueue] = {}
+        self._warm_keys = set()
+        self._lock = threading.Lock()
+        self._stats = {name: _AtomicCounter() for name in ("created", "reused", "discarded", "recycled")}
+    
+    def _queue(self, key: tuple) -> queue.LifoQueue:
+        with self._lock:
+            q = self._idle.get(key)
+            if q is None:
+                q = self._idle[key] = queue.LifoQueue()
+            return q
+    
+    def _launch(self, key: tuple):
+        """启动新浏览器"""
+        proxy, headless = key
+        page = CloudflareSolver(proxy=proxy, headless=headless, use_cache=False)._create_page()
+        page._cf_pool_key = key
+        page._cf_uses = 0
+        page._cf_state_since = time.monotonic()
+        # 访问过的源，清空状态时按源清理 localStorage 等存储
+        page._cf_origins = set()
+        self._stats["created"].inc()
+        return page
+    
+    def _refill(self, key: tuple):
+        """后台补充一个空闲浏览器"""
+        try:
+            page = self._launch(key)
+        except Exception as e:
+            logger.warning("⚠️ 预热浏览器失败: %s", e)
+            return
+        self._put_idle(page)
+    
+    def _idle_count(self) -> int:
+        with self._lock:
+            return sum(q.qsize() for q in self._idle.values())
+    
+    def _put_idle(self, page):
+        q = self._queue(page._cf_pool_key)
+        if q.qsize() >= self.size or self._idle_count() >= self.max_idle:
+            _close_page(page)
+        else:
+            q.put(page)
+    
+    def _discard(self, page, reason: str = "discarded"):
+        self._stats[reason].inc()
+        _close_page(page)
+        key = page._cf_pool_key
+        if key in self._warm_keys:
+            threading.Thread(target=self._refill, args=(key,), daemon=True).start()
+    
+    @staticmethod
+    def _is_alive(page) -> bool:
+        try:
+            return page.states.is_alive
+        except Exception:
+            return False
+    
+    def warm(self, count: Optional[int] = None, proxy: Optional[str] = None, headless: bool = True):
+        """后台预热浏览器"""
+        key = (proxy, headless)
+        self._warm_keys.add(key)
+        for _ in range(self.size if count is None else count):
+            threading.Thread(target=self._refill, args=(key,), daemon=True).start()
+    
+    @staticmethod
+    def _clear_state(page):
+        """
+        清空 cookie 和访问过的各个源的存储。
+        走 CDP 的浏览器级命令，与当前页面无关（about:blank 是不透明源，在页面里执行 JS 清不到站点的存储）
+        """
+        page.run_cdp("Network.clearBrowserCookies")
+        for origin in page._cf_origins:
+            page.run_cdp("Storage.clearDataForOrigin", origin=origin, storageTypes="all")
+        page._cf_origins.clear()
+        page._cf_state_since = time.monotonic()
+    
+    def acquire(self, proxy: Optional[str] = None, headless: bool = True, state_after: float = 0.0):
+        """取一个空闲浏览器，没有则新建；复用的浏览器保留的 cookie 早于 state_after（monotonic）时先清空"""
+        key = (proxy, headless)
+        q = self._queue(key)
+        while True:
+            try:
+                page = q.get_nowait()
+            except queue.Empty:
+                page = self._launch(key)
+                page._cf_uses += 1
+                return page
+            if self._is_alive(page):
+                if page._cf_state_since < state_after:
+                    try:
+                        self._clear_state(page)
+                    except Exception as e:
+                        logger.warning("  ⚠️ 清理浏览器失败: %s", e)
+                        self._discard(page)
+                        continue
+                self._stats["reused"].inc()
+                page._cf_uses += 1
+                return page
+            self._discard(page)
+    
+    def release(self, page, healthy: bool = True):
+        """归还浏览器；healthy=False 或达到使用次数上限时关闭"""
+        if healthy and self.max_uses and page._cf_uses >= self.max_uses:
+            self._discard(page, "recycled")
+            return
+        if healthy:
+            try:
+                origin = _origin(page.url)
+                if origin:
+                    page._cf_origins.add(origin)
+                    # sessionStorage 属于标签页，只能趁还停在站点上时清理；清不掉不影响复用
+                    try:
+                        page.run_js("sessionStorage.clear();")
+                    except Exception as e:
+                        logger.debug("清理 sessionStorage 失败: %s", e)
+                if time.monotonic() - page._cf_state_since >= self.state_ttl:
+                    self._clear_state(page)
+                page.run_cdp("Network.clearBrowserCache")
+                page.get("about:blank")
+                self._put_idle(page)
+                return
+            except Exception as e:
+                logger.warning("  ⚠️ 清理浏览器失败: %s", e)
+        self._discard(page)
+    
+    def close(self):
+        """关闭所有空闲浏览器"""
+        self._warm_keys.clear()
+        with self._lock:
+            queues = list(self._idle.values())
+        for q in queues:
+            while True:
+                try:
+                    _close_page(q.get_nowait())
+                except queue.Empty:
+                    break
+    
+    def stats(self) -> dict:
+        """浏览器池统计"""
+        counters = {name: counter.value() for name, counter in self._stats.items()}
+        return {
+            "size": self.size, "idle": self._idle_count(), "max_idle": self.max_idle,
+            "state_ttl": self.state_ttl, **counters
+        }
+
+
+@functools.lru_cache(maxsize=1)
+def get_browser_pool() -> BrowserPool:
+    """获取全局浏览器池"""
+    pool = BrowserPool()
+    atexit.register(pool.close)
+    return pool
+
+
+@functools.lru_cache(maxsize=64)
+def get_solver(proxy: Optional[str] = None, headless: bool = True, timeout: int = 60) -> CloudflareSolver:
+    """
+    按 (proxy, headless, timeout) 复用 solver 实例。
+    solver 创建后只读，浏览器由 BrowserPool 按次租借，可以在线程间共享。
+    """
+    return CloudflareSolver(proxy=proxy, headless=headless, timeout=timeout, use_cache=True)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Cloudflare Turnstile Challenge Solver")
     parser.add_argument("url", nargs="?", default="https://sora.chatgpt.com", help="目标 URL")
@@ -379,8 +963,10 @@ def main():
     parser.add_argument("-t", "--timeout", type=int, default=60, help="超时时间（秒）")
     parser.add_argument("-o", "--output", help="输出 JSON 文件路径")
     parser.add_argument("--no-cache", action="store_true", help="禁用缓存")
+    parser.add_argument("--print-cookie-str", action="store_true", help="输出可直接使用的 Cookie 字符串")
     
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     headless = args.headless  # 默认 False（有头模式）
     
     print("=" * 50)
@@ -414,13 +1000,17 @@ def main():
             print(f"  {name}: {display_value}")
         
         if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(solution.to_dict(), f, indent=2, ensure_ascii=False)
+            if orjson is not None:
+                with open(args.output, "wb") as f:
+                    f.write(orjson.dumps(solution.to_dict(), option=orjson.OPT_INDENT_2))
+            else:
+                with open(args.output, "w", encoding="utf-8") as f:
+                    json.dump(solution.to_dict(), f, indent=2, ensure_ascii=False)
             print(f"\n📁 结果已保存到: {args.output}")
         
-        print("\n📋 Cookie 字符串 (可直接使用):")
-        cookie_str = "; ".join([f"{k}={v}" for k, v in solution.cookies.items()])
-        print(cookie_str)
+        if args.print_cookie_str:
+            print("\n📋 Cookie 字符串 (可直接使用):")
+            print("; ".join(f"{k}={v}" for k, v in solution.cookies.items()))
         
     except CloudflareError as e:
         print(f"\n❌ 解决失败: {e}")
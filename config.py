@@ -1,29 +1,127 @@
 """
 配置管理模块 - 使用 SQLite 存储配置
 """
+import json
+import time
+import queue
+import atexit
 import sqlite3
 import hashlib
+import logging
 import secrets
+import itertools
 import threading
 from typing import Optional, Dict, Any
 from pathlib import Path
 
 DB_PATH = Path("data/config.db")
 
+logger = logging.getLogger(__name__)
+
+
+# 常用查询语句。sqlite3 按 SQL 文本缓存预编译语句，统一用模块级常量保证文本一致
+SQL_GET_CONFIG = "SELECT value FROM config WHERE key = ?"
+SQL_GET_CHANGE_MARKER = "SELECT version FROM change_marker WHERE id = 1"
+SQL_GET_ALL_CONFIG = "SELECT key, value, description FROM config"
+SQL_ENABLED_KEYS = "SELECT key FROM api_keys WHERE enabled = 1"
+SQL_LIST_KEYS = "SELECT id, key, name, enabled, created_at FROM api_keys"
+SQL_INSERT_LOG = (
+    "INSERT INTO request_logs (request_id, url, proxy, success, error, elapsed_seconds, from_cache) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_GET_SOLUTION = (
+    "SELECT cf_clearance, cookies, user_agent, url, created_at, expires_at "
+    "FROM solution_cache WHERE key = ? AND expires_at > ?"
+)
+SQL_SET_SOLUTION = (
+    "INSERT OR REPLACE INTO solution_cache (key, cf_clearance, cookies, user_agent, url, created_at, expires_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_GET_LOGS = (
+    "SELECT id, request_id, url, proxy, success, error, elapsed_seconds, from_cache, created_at "
+    "FROM request_logs ORDER BY id DESC LIMIT ?"
+)
+
+
+# 每个线程复用一个长连接，避免每次操作都重新打开数据库文件
+_tls = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
 
 def get_db() -> sqlite3.Connection:
-    """获取数据库连接"""
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    """获取当前线程的数据库连接（自动提交模式，不需要 close）"""
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.row_factory = sqlite3.Row
+        _tls.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
     return conn
 
 
+@atexit.register
+def close_db():
+    """关闭所有线程的数据库连接"""
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+    _tls.__dict__.clear()
+
+
+def hash_password(password: str) -> str:
+    """scrypt 哈希密码，格式 scrypt$<salt>$<hash>"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=16384, r=8, p=1)
+    return f"scrypt${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """常量时间校验密码，兼容旧版无盐 SHA-256 哈希"""
+    if stored.startswith("scrypt$"):
+        _, salt_hex, hash_hex = stored.split("$", 2)
+        digest = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt_hex), n=16384, r=8, p=1)
+        return secrets.compare_digest(digest.hex(), hash_hex)
+    return secrets.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+# 数据库结构版本，改动表结构或默认配置时加一
+SCHEMA_VERSION = 6
+
+
 def init_db():
-    """初始化数据库表"""
+    """初始化数据库表（结构版本一致时直接跳过）"""
     conn = get_db()
-    cursor = conn.cursor()
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
     
+    cursor = conn.cursor()
+    # 直接拿写锁：多个进程同时启动时，读后升级写锁的延迟事务会直接 SQLITE_BUSY 而不等待
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        _create_schema(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        cursor.execute("COMMIT")
+    except BaseException:
+        # 失败时回滚，否则本线程的连接停在未提交的事务里，之后的 BEGIN 都会报错
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def _create_schema(cursor: sqlite3.Cursor):
+    """建表、迁移并写入默认数据（在 init_db 的事务内执行）"""
     # 配置表
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS config (
@@ -68,11 +166,45 @@ def init_db():
         )
     """)
     
+    # cf_clearance 持久化缓存（服务重启后仍可复用）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS solution_cache (
+            key TEXT PRIMARY KEY,
+            cf_clearance TEXT NOT NULL,
+            cookies TEXT NOT NULL,
+            user_agent TEXT NOT NULL,
+            url TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    
+    # 配置/Key/管理员的变更计数，由触发器维护；请求日志、cf_clearance 缓存的写入不会改变它，
+    # 内存缓存据此判断是否需要重新加载（包括其他进程的修改）
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_marker (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO change_marker (id, version) VALUES (1, 0)")
+    for table in ("config", "api_keys", "admins"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_marker AFTER {event} ON {table}
+                BEGIN
+                    UPDATE change_marker SET version = version + 1 WHERE id = 1;
+                END
+            """)
+    
     # 初始化默认配置
     defaults = {
         "max_workers": ("3", "并发浏览器数量"),
         "pool_size": ("2", "预热浏览器池大小"),
+        "browser_max_uses": ("50", "单个浏览器最多使用次数，之后关闭换新(0不限制)"),
+        "browser_state_ttl": ("1200", "浏览器保留cookie的秒数，期间同站点可免验证(0每次清空)"),
         "semaphore_limit": ("3", "并发请求限制"),
+        "max_waiting": ("8", "最大排队请求数，超出返回503"),
         "cache_ttl": ("1800", "缓存过期时间(秒)"),
         "max_retries": ("0", "默认重试次数"),
         "require_api_key": ("0", "是否需要API Key验证(0/1)"),
@@ -87,11 +219,12 @@ def init_db():
         )
     
     # 创建默认管理员 admin/admin123
-    default_pwd_hash = hashlib.sha256("admin123".encode()).hexdigest()
-    cursor.execute(
-        "INSERT OR IGNORE INTO admins (username, password_hash) VALUES (?, ?)",
-        ("admin", default_pwd_hash)
-    )
+    cursor.execute("SELECT id FROM admins WHERE username = ?", ("admin",))
+    if cursor.fetchone() is None:
+        cursor.execute(
+            "INSERT INTO admins (username, password_hash) VALUES (?, ?)",
+            ("admin", hash_password("admin123"))
+        )
     
     # 创建默认 API Key
     cursor.execute("SELECT COUNT(*) FROM api_keys")
@@ -102,16 +235,23 @@ def init_db():
             (default_key, "default")
         )
         print(f"📌 默认 API Key: {default_key}")
-    
-    conn.commit()
-    conn.close()
+
+
+# 配置缓存中表示"数据库中没有该键"
+_NOT_FOUND = object()
 
 
 class ConfigManager:
-    """配置管理器"""
+    """
+    配置管理器
+    读取结果（包括不存在的键）缓存在内存中，set() 时更新。
+    其他进程改了配置/Key/管理员时，通过 change_marker 表的计数发现（最多每秒检查一次）并清空缓存；
+    请求日志等其他表的写入不会触发重新加载。
+    """
     
     _instance = None
     _lock = threading.Lock()
+    CHANGE_CHECK_INTERVAL = 1.0
     
     def __new__(cls):
         if cls._instance is None:
@@ -119,22 +259,45 @@ class ConfigManager:
                 if cls._instance is None:
                     cls._instance = super().__new__(cls)
                     cls._instance._cache = {}
+                    cls._instance._version = 0
+                    cls._instance._db_marker = None
+                    cls._instance._next_check = 0.0
         return cls._instance
     
+    @property
+    def version(self) -> int:
+        """配置版本号，每次 set/清缓存时递增，供派生缓存判断是否需要重建"""
+        self._check_external_change()
+        return self._version
+    
+    def _check_external_change(self):
+        """检查配置/Key/管理员是否被修改过（本进程的修改也会让计数变化，多一次重新加载）"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.CHANGE_CHECK_INTERVAL
+        
+        try:
+            row = get_db().execute(SQL_GET_CHANGE_MARKER).fetchone()
+        except sqlite3.OperationalError:
+            # init_db 之前表还不存在
+            return
+        marker = row[0] if row else 0
+        if self._db_marker is not None and marker != self._db_marker:
+            self.clear_cache()
+        self._db_marker = marker
+    
     def get(self, key: str, default: Any = None) -> str:
         """获取配置值"""
-        if key in self._cache:
-            return self._cache[key]
-        
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM config WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        value = row["value"] if row else default
-        self._cache[key] = value
-        return value
+        self._check_external_change()
+        try:
+            value = self._cache[key]
+        except KeyError:
+            row = get_db().execute(SQL_GET_CONFIG, (key,)).fetchone()
+            
+            value = row["value"] if row else _NOT_FOUND
+            self._cache[key] = value
+        return default if value is _NOT_FOUND else value
     
     def get_int(self, key: str, default: int = 0) -> int:
         """获取整数配置"""
@@ -154,45 +317,51 @@ class ConfigManager:
                 "UPDATE config SET value = ? WHERE key = ?",
                 (value, key)
             )
-        conn.commit()
-        conn.close()
         self._cache[key] = value
+        self._version += 1
     
     def get_all(self) -> Dict[str, Dict]:
         """获取所有配置"""
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT key, value, description FROM config")
-        rows = cursor.fetchall()
-        conn.close()
+        rows = get_db().execute(SQL_GET_ALL_CONFIG).fetchall()
         return {row["key"]: {"value": row["value"], "description": row["description"]} for row in rows}
     
     def clear_cache(self):
         """清除缓存"""
         self._cache.clear()
+        self._version += 1
 
 
 class APIKeyManager:
-    """API Key 管理器"""
+    """
+    API Key 管理器
+    已启用的 Key 缓存在内存 frozenset 中，增删改后重建；
+    其他进程修改数据库时随配置版本号变化一起重建。
+    """
+    
+    def __init__(self):
+        self._keys: Optional[frozenset] = None
+        self._version = -1
+        self._lock = threading.Lock()
+    
+    def _reload(self):
+        """从数据库重新加载已启用的 Key"""
+        with self._lock:
+            version = config.version
+            rows = get_db().execute(SQL_ENABLED_KEYS).fetchall()
+            self._keys = frozenset(row["key"] for row in rows)
+            self._version = version
     
     def validate(self, key: str) -> bool:
         """验证 API Key"""
         if not key:
             return False
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM api_keys WHERE key = ? AND enabled = 1", (key,))
-        row = cursor.fetchone()
-        conn.close()
-        return row is not None
+        if self._keys is None or self._version != config.version:
+            self._reload()
+        return key in self._keys
     
     def list_keys(self) -> list:
         """列出所有 API Key"""
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, key, name, enabled, created_at FROM api_keys")
-        rows = cursor.fetchall()
-        conn.close()
+        rows = get_db().execute(SQL_LIST_KEYS).fetchall()
         return [dict(row) for row in rows]
     
     def add_key(self, name: str = None) -> str:
@@ -201,8 +370,7 @@ class APIKeyManager:
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("INSERT INTO api_keys (key, name) VALUES (?, ?)", (key, name or "unnamed"))
-        conn.commit()
-        conn.close()
+        self._reload()
         return key
     
     def delete_key(self, key_id: int):
@@ -210,37 +378,63 @@ class APIKeyManager:
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
-        conn.commit()
-        conn.close()
+        self._reload()
     
     def toggle_key(self, key_id: int, enabled: bool):
         """启用/禁用 API Key"""
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("UPDATE api_keys SET enabled = ? WHERE id = ?", (1 if enabled else 0, key_id))
-        conn.commit()
-        conn.close()
+        self._reload()
+
+
+_DUMMY_HASH = hash_password(secrets.token_urlsafe(16))
 
 
 class AdminManager:
-    """管理员管理器"""
+    """
+    管理员管理器
+    密码哈希缓存在内存中，登录不再查库；数据库被其他进程修改（配置版本号变化）时重新读取
+    """
+    
+    def __init__(self):
+        self._hashes: Dict[str, str] = {}
+        self._version = -1
+    
+    def _get_hash(self, username: str) -> Optional[str]:
+        """获取用户的密码哈希，用户不存在时返回 None"""
+        version = config.version
+        if version != self._version:
+            self._hashes = {}
+            self._version = version
+        stored = self._hashes.get(username)
+        if stored is None:
+            # 只缓存存在的用户，随意尝试的用户名不会撑大缓存
+            row = get_db().execute("SELECT password_hash FROM admins WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            stored = self._hashes[username] = row["password_hash"]
+        return stored
     
     def verify(self, username: str, password: str) -> bool:
         """验证管理员登录"""
-        pwd_hash = hashlib.sha256(password.encode()).hexdigest()
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id FROM admins WHERE username = ? AND password_hash = ?",
-            (username, pwd_hash)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        return row is not None
+        stored = self._get_hash(username)
+        if stored is None:
+            # 用户不存在时也做一次哈希，避免通过响应时间枚举用户名
+            verify_password(password, _DUMMY_HASH)
+            return False
+        
+        if not verify_password(password, stored):
+            return False
+        
+        # 旧版 SHA-256 哈希在登录成功后升级为 scrypt
+        if not stored.startswith("scrypt$"):
+            self.change_password(username, password)
+        return True
     
     def change_password(self, username: str, new_password: str) -> bool:
         """修改密码"""
-        pwd_hash = hashlib.sha256(new_password.encode()).hexdigest()
+        pwd_hash = hash_password(new_password)
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute(
@@ -248,16 +442,24 @@ class AdminManager:
             (pwd_hash, username)
         )
         affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        if affected > 0:
+            self._hashes[username] = pwd_hash
         return affected > 0
 
 
 class ProxyPoolManager:
-    """代理池管理器 - 简化版，从配置读取代理列表"""
+    """
+    代理池管理器 - 简化版，从配置读取代理列表
+    解析结果缓存为元组，配置版本号变化时才重新解析
+    各代理的成功/失败次数只记在内存里，不写数据库
+    """
     
-    _current_index = 0
-    _lock = threading.Lock()
+    def __init__(self):
+        self._results: Dict[str, list] = {}
+        self._parsed: tuple = ()
+        self._version = -1
+        # itertools.count 的 next() 是原子的，并发轮询也不会重复或跳过代理
+        self._counter = itertools.count()
     
     def parse_proxy(self, line: str) -> Optional[str]:
         """
@@ -284,66 +486,151 @@ class ProxyPoolManager:
             # ip:port -> http://ip:port
             return f"http://{line}"
     
+    def _snapshot(self) -> tuple:
+        """当前代理列表快照"""
+        version = config.version
+        if version != self._version:
+            proxy_text = config.get("proxy_list", "")
+            self._parsed = tuple(
+                proxy for proxy in map(self.parse_proxy, proxy_text.split('\n')) if proxy
+            )
+            self._version = version
+        return self._parsed
+    
     def get_proxy_list(self) -> list:
         """获取所有代理"""
-        proxy_text = config.get("proxy_list", "")
-        proxies = []
-        for line in proxy_text.split('\n'):
-            proxy = self.parse_proxy(line)
-            if proxy:
-                proxies.append(proxy)
-        return proxies
+        return list(self._snapshot())
     
     def get_next_proxy(self) -> Optional[str]:
-        """轮询获取下一个代理"""
-        proxies = self.get_proxy_list()
+        """轮询获取下一个代理（无锁）"""
+        proxies = self._snapshot()
         if not proxies:
             return None
-        
-        with self._lock:
-            proxy = proxies[self._current_index % len(proxies)]
-            self._current_index += 1
-        return proxy
+        return proxies[next(self._counter) % len(proxies)]
     
     def get_proxy_count(self) -> int:
         """获取代理数量"""
-        return len(self.get_proxy_list())
+        return len(self._snapshot())
+    
+    def record_result(self, proxy: str, success: bool):
+        """记录一次使用结果（由事件循环线程调用）"""
+        counts = self._results.get(proxy)
+        if counts is None:
+            counts = self._results[proxy] = [0, 0]
+        counts[0 if success else 1] += 1
+    
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """当前代理列表中各代理的成功/失败次数"""
+        result = {}
+        for proxy in self._snapshot():
+            success, failed = self._results.get(proxy, (0, 0))
+            result[proxy] = {"success": success, "failed": failed}
+        return result
 
 
 class RequestLogger:
-    """请求日志管理器"""
+    """
+    请求日志管理器
+    log() 只把记录放进队列，由后台线程批量写入，请求路径上不做磁盘 IO
+    """
+    
+    BATCH_SIZE = 256
+    
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        atexit.register(self.flush, 5)
+    
+    def _ensure_writer(self):
+        """按需启动后台写入线程"""
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="request-logger", daemon=True)
+                    self._writer.start()
+    
+    def _write_loop(self):
+        """后台线程：取出一批日志，一个事务写入"""
+        conn = get_db()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            # flush() 放入的 Event 用来通知调用方之前的记录已写完
+            rows = [item for item in batch if not isinstance(item, threading.Event)]
+            if rows:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(SQL_INSERT_LOG, rows)
+                    conn.execute("COMMIT")
+                except sqlite3.Error as e:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    logger.warning("⚠️ 写入请求日志失败: %s", e)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
     
     def log(self, request_id: str, url: str, proxy: str, success: bool, 
             error: str = None, elapsed: float = 0, from_cache: bool = False):
-        """记录请求日志"""
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO request_logs (request_id, url, proxy, success, error, elapsed_seconds, from_cache)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (request_id, url, proxy, 1 if success else 0, error, elapsed, 1 if from_cache else 0))
-        conn.commit()
-        conn.close()
+        """记录请求日志（异步写入）"""
+        self._ensure_writer()
+        self._queue.put((request_id, url, proxy, 1 if success else 0, error, elapsed, 1 if from_cache else 0))
+    
+    def flush(self, timeout: float = None) -> bool:
+        """等待已提交的日志全部写入"""
+        if self._writer is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
     
     def get_logs(self, limit: int = 100) -> list:
         """获取最近的日志"""
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, request_id, url, proxy, success, error, elapsed_seconds, from_cache, created_at 
-            FROM request_logs ORDER BY id DESC LIMIT ?
-        """, (limit,))
-        rows = cursor.fetchall()
-        conn.close()
+        rows = get_db().execute(SQL_GET_LOGS, (limit,)).fetchall()
         return [dict(row) for row in rows]
     
-    def clear_logs(self):
-        """清空日志"""
+    def clear_logs(self, timeout: float = 5):
+        """清空日志（先等待队列中的日志写完，最多等待 timeout 秒）"""
+        self.flush(timeout)
         conn = get_db()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM request_logs")
-        conn.commit()
-        conn.close()
+
+
+class SolutionStore:
+    """
+    cf_clearance 二级缓存，存在 SQLite 中
+    内存缓存未命中时查这里：服务重启后之前解出的结果仍能复用
+    时间用墙钟时间（time.time），服务重启后仍可比较
+    """
+    
+    def get(self, key: str) -> Optional[sqlite3.Row]:
+        """获取未过期的记录"""
+        return get_db().execute(SQL_GET_SOLUTION, (key, time.time())).fetchone()
+    
+    def set(self, key: str, cf_clearance: str, cookies: Dict[str, str], user_agent: str, url: str, ttl: float):
+        """保存记录，顺带清理已过期的记录"""
+        now = time.time()
+        conn = get_db()
+        conn.execute("DELETE FROM solution_cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            SQL_SET_SOLUTION,
+            (key, cf_clearance, json.dumps(cookies), user_agent, url, now, now + ttl)
+        )
+    
+    def delete(self, key: str):
+        """删除记录"""
+        get_db().execute("DELETE FROM solution_cache WHERE key = ?", (key,))
+    
+    def clear(self):
+        """清空所有记录"""
+        get_db().execute("DELETE FROM solution_cache")
 
 
 # 全局实例
@@ -352,3 +639,4 @@ api_keys = APIKeyManager()
 admins = AdminManager()
 proxy_pool = ProxyPoolManager()
 request_logger = RequestLogger()
+solution_store = SolutionStore()
@@ -2,52 +2,287 @@
 Cloudflare Challenge API Server
 支持 API Key 验证 + SQLite 配置管理 + 后台管理
 """
+import os
+import gzip
 import time
-import uuid
+import queue
+import logging
+import logging.handlers
 import asyncio
+import functools
+import threading
 import secrets
 import hashlib
+import sqlite3
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
-from typing import Optional
-from contextlib import asynccontextmanager
+from typing import Optional, Dict
+from datetime import datetime
+from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, HTTPException, Query, Request, Depends, Header
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from pydantic import BaseModel, ConfigDict
+import orjson
 
 # 获取项目根目录
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
+# 仪表盘脚本按内容哈希加版本号，浏览器可以长期缓存，内容变了 URL 随之变化
+DASHBOARD_JS_VERSION = hashlib.blake2b((STATIC_DIR / "dashboard.js").read_bytes(), digest_size=4).hexdigest()
+
+
+class StaticPage:
+    """
+    启动时读入内存的 HTML 页面，同时预先压缩好 gzip 版本
+    带 ETag 和 5 分钟缓存，浏览器过期后用 If-None-Match 校验，内容没变时返回 304
+    """
+    __slots__ = ("body", "gzipped", "etag", "headers")
+    
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        # gzip 与原文是同一内容的两种编码，用弱 ETag
+        self.etag = 'W/"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        self.headers = {"ETag": self.etag, "Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+    
+    def response(self, request: Request) -> Response:
+        if request.headers.get("if-none-match") == self.etag:
+            return Response(status_code=304, headers=self.headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            return Response(
+                content=self.gzipped,
+                media_type="text/html",
+                headers={**self.headers, "Content-Encoding": "gzip"}
+            )
+        return Response(content=self.body, media_type="text/html", headers=self.headers)
+
+
+# 页面启动时读入内存，避免每次 stat + 读文件
+INDEX_PAGE = StaticPage((STATIC_DIR / "index.html").read_bytes().replace(
+    b"/static/dashboard.js", f"/static/dashboard.js?v={DASHBOARD_JS_VERSION}".encode()
+))
+ADMIN_PAGE = StaticPage((STATIC_DIR / "admin.html").read_bytes())
+LOGIN_PAGE = StaticPage((STATIC_DIR / "login.html").read_bytes())
 from cloudflare_solver import (
-    CloudflareSolver, CloudflareError, get_cache
+    CloudflareSolution, get_cache, get_browser_pool, get_solver
 )
-from config import init_db, config, api_keys, admins, proxy_pool, request_logger, ConfigManager
+from config import init_db, config, api_keys, admins, proxy_pool, request_logger, solution_store
+
+logger = logging.getLogger("server")
+# 输出 INFO 日志的本项目 logger
+APP_LOGGERS = ("server", "cloudflare_solver", "config")
+
+
+class ORJSONResponse(JSONResponse):
+    """用 orjson 序列化的 JSON 响应（直接输出 bytes，比标准库 json 快数倍）"""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class ORJSONRequest(Request):
+    """用 orjson 解析 JSON 请求体（orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，仍返回 422）"""
+    
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+
+class ORJSONRoute(APIRoute):
+    """带请求体的路由（管理接口的 POST/PUT）改用 ORJSONRequest；GET 路由保持原样，不多包一层"""
+    
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        if self.body_field is None:
+            return handler
+        
+        async def route_handler(request: Request):
+            return await handler(ORJSONRequest(request.scope, request.receive))
+        
+        return route_handler
+
+
+@contextmanager
+def queued_logging():
+    """
+    日志改走队列：请求处理中只把记录放入队列，
+    由后台线程统一格式化并写到 stdout。
+    只把本项目的 logger 调到 INFO（退出时恢复），第三方库仍按根 logger 的级别输出
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    app_loggers = [logging.getLogger(name) for name in APP_LOGGERS]
+    old_levels = [app_logger.level for app_logger in app_loggers]
+    for app_logger in app_loggers:
+        app_logger.setLevel(logging.INFO)
+    listener.start()
+    try:
+        yield
+    finally:
+        for app_logger, level in zip(app_loggers, old_levels):
+            app_logger.setLevel(level)
+        root.removeHandler(queue_handler)
+        listener.stop()
 
 # 并发控制
 request_semaphore: Optional[asyncio.Semaphore] = None
 executor: Optional[ThreadPoolExecutor] = None
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+# 排队请求上限，超出直接返回 503
+max_waiting = 8
+
+
+class InflightSolve:
+    """
+    进行中的浏览器验证，相同请求共享同一个结果。
+    waiters 为正在等待结果的其他请求数，发起者断开时只有没人等待才真正取消
+    """
+    __slots__ = ("future", "cancel_event", "waiters")
+    
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.cancel_event = threading.Event()
+        self.waiters = 0
+
+
+# 正在验证中的请求，key 为 (url, proxy, headless)；相同请求合并为一次浏览器验证
+inflight: Dict[tuple, InflightSolve] = {}
+
+# 等待 solve 期间检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 1.0
+
+# /v1/stats、/v1/queue 的预序列化快照及刷新间隔（秒）
+STATS_REFRESH_INTERVAL = 0.5
+stats_json = b"{}"
+queue_json = b"{}"
+# 统计变化时置位后替换为新 Event，/v1/stats/stream 据此推送
+stats_changed: Optional[asyncio.Event] = None
+# SSE 连接的心跳间隔与最长保持时间（秒），到期后浏览器自动重连，避免长连接拖住关闭
+SSE_KEEPALIVE = 15
+SSE_MAX_DURATION = 60
+
+# 统计信息（只在事件循环线程中修改）
+@dataclass(slots=True)
+class Stats:
+    total_requests: int = 0
+    success: int = 0
+    failed: int = 0
+    cache_hits: int = 0
+    total_time: float = 0.0
+    queue_waiting: int = 0
+    processing: int = 0
+    start_time: Optional[float] = None
+    
+    @property
+    def avg_time(self) -> float:
+        """浏览器验证的平均耗时（读取时计算，不含缓存命中）"""
+        solved = self.success - self.cache_hits
+        return self.total_time / solved if solved else 0.0
+    
+    @property
+    def success_rate(self) -> str:
+        """成功率（读取时计算）"""
+        total = self.total_requests
+        return f"{self.success / total * 100:.1f}%" if total > 0 else "0%"
+
+
+stats = Stats()
+
+class SessionStore:
+    """
+    管理员 session，固定有效期。按创建顺序保存，过期的总在最前面，
+    登录时顺带清理；数量超过上限时淘汰最早的 session
+    """
+    
+    def __init__(self, ttl: float = 12 * 3600, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def create(self, username: str) -> str:
+        now = time.monotonic()
+        while self._sessions:
+            _, (_, expires_at) = next(iter(self._sessions.items()))
+            if expires_at > now and len(self._sessions) < self.max_size:
+                break
+            self._sessions.popitem(last=False)
+        token = secrets.token_urlsafe(32)
+        self._sessions[token] = (username, now + self.ttl)
+        return token
+    
+    def get(self, token: str) -> Optional[str]:
+        """token 有效时返回用户名（token 是 256 位随机数，哈希查找不会泄露可利用的时序信息）"""
+        session = self._sessions.get(token)
+        if session is None:
+            return None
+        username, expires_at = session
+        if expires_at <= time.monotonic():
+            self._sessions.pop(token, None)
+            return None
+        return username
+
+
+class LoginThrottle:
+    """
+    按 (用户名, 客户端 IP) 统计登录失败次数，窗口内失败过多时直接拒绝，不再计算密码哈希。
+    反向代理后所有请求的 IP 相同，只按 IP 统计时任何人输错几次就会锁住所有管理员。
+    记录按创建顺序保存（过期的总在最前面），数量超过上限时淘汰最早的记录
+    """
+    
+    def __init__(self, max_failures: int = 5, window: float = 300, max_clients: int = 4096):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_clients = max_clients
+        self._failures: "OrderedDict[tuple, list]" = OrderedDict()
+    
+    def blocked(self, key: tuple) -> bool:
+        record = self._failures.get(key)
+        if record is None:
+            return False
+        if record[1] <= time.monotonic():
+            del self._failures[key]
+            return False
+        return record[0] >= self.max_failures
+    
+    def fail(self, key: tuple):
+        record = self._failures.get(key)
+        if record is None:
+            now = time.monotonic()
+            while self._failures:
+                _, (_, expires_at) = next(iter(self._failures.items()))
+                if expires_at > now and len(self._failures) < self.max_clients:
+                    break
+                self._failures.popitem(last=False)
+            record = self._failures[key] = [0, now + self.window]
+        record[0] += 1
+    
+    def reset(self, key: tuple):
+        self._failures.pop(key, None)
 
-# 统计信息
-stats = {
-    "total_requests": 0,
-    "success": 0,
-    "failed": 0,
-    "cache_hits": 0,
-    "avg_time": 0.0,
-    "total_time": 0.0,
-    "queue_waiting": 0,
-    "processing": 0,
-    "start_time": None
-}
 
 # 管理员 session
-admin_sessions = {}
+admin_sessions = SessionStore()
+login_throttle = LoginThrottle()
 
 
 def get_config_int(key: str, default: int) -> int:
-    """获取配置（优先环境变量）"""
-    import os
+    """
+    获取配置（优先环境变量）
+    数据库配置由 config 缓存在内存中，请求路径上调用（如 max_retries）不会查询 SQLite
+    """
     env_val = os.environ.get(key.upper())
     if env_val:
         return int(env_val)
@@ -57,43 +292,102 @@ def get_config_int(key: str, default: int) -> int:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    global request_semaphore, executor
-    
-    print("🚀 初始化服务...")
-    
-    # 初始化数据库
-    init_db()
-    
-    stats["start_time"] = time.time()
-    
-    # 从配置加载参数
-    max_workers = get_config_int("max_workers", 3)
-    semaphore_limit = get_config_int("semaphore_limit", 3)
+    global request_semaphore, executor, event_loop, max_waiting, stats_changed
     
-    print(f"   MAX_WORKERS={max_workers}, SEMAPHORE={semaphore_limit}")
-    
-    request_semaphore = asyncio.Semaphore(semaphore_limit)
-    executor = ThreadPoolExecutor(max_workers=max_workers)
-    
-    print("✅ 服务就绪")
-    
-    yield
-    
-    print("🛑 关闭服务...")
-    if executor:
-        executor.shutdown(wait=False)
+    with queued_logging():
+        logger.info("🚀 初始化服务...")
+        
+        # 初始化数据库
+        init_db()
+        
+        stats.start_time = time.time()
+        
+        # 从配置加载参数
+        max_workers = get_config_int("max_workers", 3)
+        semaphore_limit = get_config_int("semaphore_limit", 3)
+        pool_size = get_config_int("pool_size", 2)
+        browser_max_uses = get_config_int("browser_max_uses", 50)
+        browser_state_ttl = get_config_int("browser_state_ttl", 1200)
+        max_waiting = get_config_int("max_waiting", 8)
+        get_cache().ttl = get_config_int("cache_ttl", 1800)
+        
+        logger.info(
+            "   MAX_WORKERS=%s, SEMAPHORE=%s, POOL_SIZE=%s, MAX_WAITING=%s",
+            max_workers, semaphore_limit, pool_size, max_waiting
+        )
+        
+        # 信号量不超过线程数，超出的请求都在信号量上排队（FIFO、可取消、计入 queue_waiting），
+        # 不会越过信号量后再堵在线程池内部队列里
+        request_semaphore = asyncio.Semaphore(min(semaphore_limit, max_workers))
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cf-solver")
+        event_loop = asyncio.get_running_loop()
+        
+        # 预热浏览器池（后台启动，不阻塞服务就绪）
+        browser_pool = get_browser_pool()
+        browser_pool.size = pool_size
+        browser_pool.max_uses = browser_max_uses
+        browser_pool.state_ttl = browser_state_ttl
+        # 空闲浏览器总数不超过同时能用上的数量
+        browser_pool.max_idle = max(pool_size, max_workers)
+        if pool_size > 0:
+            browser_pool.warm()
+        
+        publish_stats()
+        stats_changed = asyncio.Event()
+        stats_task = asyncio.create_task(refresh_stats_loop())
+        
+        logger.info("✅ 服务就绪")
+        
+        yield
+        
+        logger.info("🛑 关闭服务...")
+        stats_task.cancel()
+        if executor:
+            executor.shutdown(wait=False)
+        browser_pool.close()
+        # 服务停止前写完队列里的请求日志，不依赖进程退出时的 atexit
+        await asyncio.to_thread(request_logger.flush, 5)
 
 
 app = FastAPI(
     title="Cloudflare Challenge API",
     version="2.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
+app.router.route_class = ORJSONRoute
+
+
+class AdminGZipMiddleware(GZipMiddleware):
+    """
+    只压缩管理接口（/api/）和静态资源（/static/）的响应，如日志列表、配置。
+    /v1 热路径、SSE 流和已预压缩的页面原样返回，不做额外的压缩
+    """
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(("/api/", "/static/")):
+            await super().__call__(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(AdminGZipMiddleware, minimum_size=1000, compresslevel=5)
+
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    """错误响应同样用 orjson 编码（/v1/challenge 的失败响应带 detail 字典）；204/304 与 Starlette 一样不带响应体"""
+    if exc.status_code in (204, 304):
+        return Response(status_code=exc.status_code, headers=exc.headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
 
 
 # ============ 模型 ============
 
 class ChallengeResponse(BaseModel):
+    """只用于生成 OpenAPI 文档，运行时由 ORJSONResponse 直接编码，校验器延迟到首次使用时再构建"""
+    model_config = ConfigDict(defer_build=True)
+    
     success: bool
     cf_clearance: str
     cookies: dict
@@ -103,12 +397,6 @@ class ChallengeResponse(BaseModel):
     from_cache: bool = False
 
 
-class ErrorResponse(BaseModel):
-    success: bool = False
-    error: str
-    request_id: str
-
-
 # ============ API Key 验证 ============
 
 async def verify_api_key(
@@ -132,17 +420,122 @@ async def verify_admin(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    token = authorization[7:]
-    if token not in admin_sessions:
+    username = admin_sessions.get(authorization[7:])
+    if username is None:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    return admin_sessions[token]
+    return username
 
 
 # ============ 主要 API ============
 
-@app.get("/v1/challenge", response_model=ChallengeResponse, dependencies=[Depends(verify_api_key)])
+async def lookup_cache(url: str, proxy: Optional[str]) -> Optional[CloudflareSolution]:
+    """
+    先查内存缓存，未命中再查 SQLite 持久化缓存，命中后回填内存缓存
+    SQLite 查询放到线程里执行，数据库被锁时不阻塞事件循环
+    """
+    cache = get_cache()
+    solution = cache.get(url, proxy)
+    if solution is not None:
+        return solution
+    
+    try:
+        row = await asyncio.to_thread(solution_store.get, cache.key_for(url, proxy))
+    except sqlite3.Error as e:
+        logger.warning("⚠️ 读取持久化缓存失败: %s", e)
+        return None
+    if row is None:
+        return None
+    age = time.time() - row["created_at"]
+    solution = CloudflareSolution(
+        cf_clearance=row["cf_clearance"],
+        cookies=orjson.loads(row["cookies"]),
+        user_agent=row["user_agent"],
+        url=row["url"] or url,
+        created_at=datetime.fromtimestamp(row["created_at"]),
+        created_at_mono=time.monotonic() - age
+    )
+    cache.set(url, solution, proxy, ttl=row["expires_at"] - time.time())
+    return solution
+
+
+def record_outcome(
+    request_id: str,
+    url: str,
+    proxy: Optional[str],
+    start_time: float,
+    error: Optional[str] = None,
+    from_cache: bool = False
+) -> float:
+    """记录一次请求的结果：更新统计并写请求日志，返回耗时"""
+    elapsed = time.time() - start_time
+    if error is not None:
+        stats.failed += 1
+    else:
+        stats.success += 1
+        if from_cache:
+            stats.cache_hits += 1
+        else:
+            stats.total_time += elapsed
+    request_logger.log(request_id, url, proxy, error is None, error, elapsed, from_cache)
+    return elapsed
+
+
+def _retrieve_exception(future: asyncio.Future):
+    """没有其他请求等待时也要取走异常，避免 "exception was never retrieved" 警告"""
+    if not future.cancelled():
+        future.exception()
+
+
+def encode_cache_hit(solution, request_id: str, elapsed: float) -> bytes:
+    """
+    编码缓存命中的响应。cookie 等不变部分只在第一次命中时序列化，
+    之后每次只拼接 elapsed_seconds / request_id
+    """
+    prefix = solution.response_prefix
+    if prefix is None:
+        prefix = orjson.dumps({
+            "success": True,
+            "cf_clearance": solution.cf_clearance,
+            "cookies": solution.cookies,
+            "user_agent": solution.user_agent,
+        })[:-1] + b',"elapsed_seconds":'
+        solution.response_prefix = prefix
+    return b"".join((
+        prefix, orjson.dumps(round(elapsed, 2)),
+        b',"request_id":"', request_id.encode(), b'","from_cache":true}'
+    ))
+
+
+async def run_solver(request: Request, solver, url: str, skip_cache: bool, max_retries: int, solve: InflightSolve):
+    """
+    在线程池中执行 solve。客户端断开且没有其他请求在等待同一结果时通知 solver 放弃，尽快让出浏览器；
+    还有人等待时继续验证，结果交给等待者
+    """
+    cancel_event = solve.cancel_event
+    future = event_loop.run_in_executor(
+        executor,
+        functools.partial(solver.solve, url, skip_cache=skip_cache, max_retries=max_retries, cancel_event=cancel_event)
+    )
+    try:
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return future.result()
+            if solve.waiters == 0 and await request.is_disconnected():
+                logger.info("  🔌 客户端已断开，取消验证: %s", url)
+                cancel_event.set()
+                return await future
+    except asyncio.CancelledError:
+        cancel_event.set()
+        # 取消后线程里的 solve 仍会以异常结束，没人再等待，取走异常避免告警
+        future.add_done_callback(_retrieve_exception)
+        raise
+
+
+@app.get("/v1/challenge", responses={200: {"model": ChallengeResponse}}, dependencies=[Depends(verify_api_key)])
 async def solve_challenge(
+    request: Request,
     url: str = Query(default="https://sora.chatgpt.com"),
     proxy: Optional[str] = Query(default=None),
     timeout: int = Query(default=60, ge=10, le=300),
@@ -150,117 +543,203 @@ async def solve_challenge(
     skip_cache: bool = Query(default=False),
     max_retries: Optional[int] = Query(default=None, ge=0, le=10)
 ):
-    """解决 Cloudflare Challenge"""
-    request_id = str(uuid.uuid4())[:8]
+    """
+    解决 Cloudflare Challenge
+    直接返回 ORJSONResponse，跳过 ChallengeResponse 的构造与校验；ChallengeResponse 只出现在文档的 responses 中
+    """
+    request_id = secrets.token_hex(4)
     start_time = time.time()
     
-    stats["total_requests"] += 1
-    stats["queue_waiting"] += 1
-    
     # 如果启用代理池且没有指定代理，从代理池获取
     use_proxy = proxy
+    from_pool = False
     if not use_proxy and config.get("proxy_pool_enabled", "0") == "1":
         use_proxy = proxy_pool.get_next_proxy()
+        from_pool = use_proxy is not None
         if use_proxy:
-            print(f"  📡 使用代理池: {use_proxy}")
+            logger.info("  📡 使用代理池: %s", use_proxy)
+    
+    # 检查缓存（不占用并发名额）
+    if not skip_cache:
+        cached = await lookup_cache(url, use_proxy)
+        if cached:
+            stats.total_requests += 1
+            elapsed = record_outcome(request_id, url, use_proxy, start_time, from_cache=True)
+            return Response(content=encode_cache_hit(cached, request_id, elapsed), media_type="application/json")
+    
+    # 相同请求正在验证时直接等待它的结果，不再占用浏览器；
+    # 原验证被取消（发起者断开或任务被取消）时不报错，由等待者重新发起
+    key = (url, use_proxy, headless)
+    counted = False
+    while True:
+        pending = inflight.get(key)
+        if pending is None:
+            break
+        if not counted:
+            stats.total_requests += 1
+            counted = True
+        pending.waiters += 1
+        try:
+            await asyncio.wait({pending.future})
+        finally:
+            pending.waiters -= 1
+        if pending.future.cancelled():
+            continue
+        if pending.future.exception() is not None:
+            error = str(pending.future.exception())
+            record_outcome(request_id, url, use_proxy, start_time, error=error)
+            raise HTTPException(status_code=500, detail={"success": False, "error": error, "request_id": request_id})
+        elapsed = record_outcome(request_id, url, use_proxy, start_time, from_cache=True)
+        return Response(content=encode_cache_hit(pending.future.result(), request_id, elapsed), media_type="application/json")
+    
+    # 排队已满时立即拒绝，避免请求堆积到超时
+    if stats.queue_waiting >= max_waiting:
+        error = "服务繁忙，请稍后重试"
+        if counted:
+            # 作为等待者已计入请求数，接手验证失败也要计入失败
+            record_outcome(request_id, url, use_proxy, start_time, error=error)
+        raise HTTPException(status_code=503, detail={"success": False, "error": error, "request_id": request_id})
+    
+    if not counted:
+        stats.total_requests += 1
+    stats.queue_waiting += 1
+    
+    solver = get_solver(use_proxy, headless, timeout)
+    # 获取重试次数配置
+    retries = max_retries if max_retries is not None else get_config_int("max_retries", 0)
+    
+    solve = InflightSolve(event_loop.create_future())
+    solve.future.add_done_callback(_retrieve_exception)
+    inflight[key] = solve
     
     try:
+        waiting = True
+        # 信号量只包住浏览器验证本身，日志和响应构造不占名额
         async with request_semaphore:
-            stats["queue_waiting"] -= 1
-            stats["processing"] += 1
-            
-            # 检查缓存
-            if not skip_cache:
-                cache = get_cache()
-                cached = cache.get(url, use_proxy)
-                if cached:
-                    elapsed = time.time() - start_time
-                    stats["success"] += 1
-                    stats["cache_hits"] += 1
-                    # 记录日志
-                    request_logger.log(request_id, url, use_proxy, True, None, elapsed, True)
-                    return ChallengeResponse(
-                        success=True,
-                        cf_clearance=cached.cf_clearance,
-                        cookies=cached.cookies,
-                        user_agent=cached.user_agent,
-                        elapsed_seconds=round(elapsed, 2),
-                        request_id=request_id,
-                        from_cache=True
-                    )
-            
-            solver = CloudflareSolver(
-                proxy=use_proxy,
-                headless=headless,
-                timeout=timeout,
-                use_cache=True
-            )
-            
-            # 获取重试次数配置
-            retries = max_retries if max_retries is not None else get_config_int("max_retries", 0)
-            
+            waiting = False
+            stats.queue_waiting -= 1
+            stats.processing += 1
             try:
-                loop = asyncio.get_event_loop()
-                solution = await loop.run_in_executor(
-                    executor,
-                    lambda: solver.solve(url, skip_cache=skip_cache, max_retries=retries)
-                )
-                
-                elapsed = time.time() - start_time
-                stats["success"] += 1
-                stats["total_time"] += elapsed
-                stats["avg_time"] = stats["total_time"] / stats["success"]
-                
-                # 记录日志
-                request_logger.log(request_id, url, use_proxy, True, None, elapsed, False)
-                
-                return ChallengeResponse(
-                    success=True,
-                    cf_clearance=solution.cf_clearance,
-                    cookies=solution.cookies,
-                    user_agent=solution.user_agent,
-                    elapsed_seconds=round(elapsed, 2),
-                    request_id=request_id,
-                    from_cache=False
-                )
-                
-            except CloudflareError as e:
-                elapsed = time.time() - start_time
-                stats["failed"] += 1
-                # 记录日志
-                request_logger.log(request_id, url, use_proxy, False, str(e), elapsed, False)
-                raise HTTPException(status_code=500, detail={"success": False, "error": str(e), "request_id": request_id})
-            except Exception as e:
-                elapsed = time.time() - start_time
-                stats["failed"] += 1
-                request_logger.log(request_id, url, use_proxy, False, str(e), elapsed, False)
-                raise HTTPException(status_code=500, detail={"success": False, "error": str(e), "request_id": request_id})
+                solution = await run_solver(request, solver, url, skip_cache, retries, solve)
             finally:
-                stats["processing"] -= 1
-                
+                stats.processing -= 1
     except asyncio.CancelledError:
-        stats["queue_waiting"] -= 1
+        if waiting:
+            stats.queue_waiting -= 1
         raise
+    except Exception as e:
+        # CloudflareError 与其他异常返回相同的错误结构；
+        # 主动取消的验证不把错误交给等待者（future 在 finally 中取消，等待者会重新发起）
+        if not solve.cancel_event.is_set():
+            solve.future.set_exception(e)
+        if from_pool:
+            proxy_pool.record_result(use_proxy, False)
+        error = str(e)
+        record_outcome(request_id, url, use_proxy, start_time, error=error)
+        # 错误信息已在 detail 中，不再把原异常链到 HTTPException 上
+        raise HTTPException(status_code=500, detail={"success": False, "error": error, "request_id": request_id}) from None
+    else:
+        solve.future.set_result(solution)
+    finally:
+        solve.future.cancel()
+        del inflight[key]
+    
+    if from_pool:
+        proxy_pool.record_result(use_proxy, True)
+    # 写入持久化缓存，服务重启后也能复用（在线程中执行，不阻塞事件循环；写失败不影响本次结果）
+    cache = get_cache()
+    try:
+        await asyncio.to_thread(
+            solution_store.set, cache.key_for(url, use_proxy), solution.cf_clearance, solution.cookies,
+            solution.user_agent, url, cache.ttl_for(url)
+        )
+    except sqlite3.Error as e:
+        logger.warning("⚠️ 写入持久化缓存失败: %s", e)
+    
+    elapsed = record_outcome(request_id, url, use_proxy, start_time)
+    
+    return ORJSONResponse({
+        "success": True,
+        "cf_clearance": solution.cf_clearance,
+        "cookies": solution.cookies,
+        "user_agent": solution.user_agent,
+        "elapsed_seconds": round(elapsed, 2),
+        "request_id": request_id,
+        "from_cache": False
+    })
+
+
+def build_public_stats() -> dict:
+    """汇总公开统计信息"""
+    return {
+        "total_requests": stats.total_requests,
+        "success": stats.success,
+        "failed": stats.failed,
+        "success_rate": stats.success_rate,
+        "cache_hits": stats.cache_hits,
+        "avg_time": round(stats.avg_time, 2),
+        "uptime_seconds": round(time.time() - stats.start_time, 0) if stats.start_time else 0,
+        "queue_waiting": stats.queue_waiting,
+        "processing": stats.processing,
+        "cache_stats": get_cache().stats(),
+        "pool_stats": get_browser_pool().stats()
+    }
+
+
+def publish_stats() -> dict:
+    """重新生成 /v1/stats、/v1/queue 的响应快照"""
+    global stats_json, queue_json
+    data = build_public_stats()
+    stats_json = orjson.dumps(data)
+    queue_json = orjson.dumps({
+        "waiting": data["queue_waiting"],
+        "processing": data["processing"],
+        "pool": data["pool_stats"]
+    })
+    return data
+
+
+async def refresh_stats_loop():
+    """定时刷新统计快照；除运行时间外有变化时通知 SSE 订阅者"""
+    global stats_changed
+    last = None
+    while True:
+        await asyncio.sleep(STATS_REFRESH_INTERVAL)
+        data = publish_stats()
+        data.pop("uptime_seconds")
+        if data != last:
+            last = data
+            stats_changed.set()
+            stats_changed = asyncio.Event()
 
 
 @app.get("/v1/stats")
 async def get_stats():
-    """获取统计信息"""
-    cache = get_cache()
-    total = stats["total_requests"]
+    """获取统计信息（最多滞后 STATS_REFRESH_INTERVAL 秒）"""
+    return Response(content=stats_json, media_type="application/json")
+
+
+@app.get("/v1/stats/stream")
+async def stream_stats():
+    """以 Server-Sent Events 推送统计信息，只在数据变化时发送"""
+    async def events():
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        changed = stats_changed
+        yield b"retry: 1000\ndata: " + stats_json + b"\n\n"
+        while time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(changed.wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            changed = stats_changed
+            yield b"data: " + stats_json + b"\n\n"
     
-    return {
-        "total_requests": total,
-        "success": stats["success"],
-        "failed": stats["failed"],
-        "success_rate": f"{stats['success'] / total * 100:.1f}%" if total > 0 else "0%",
-        "cache_hits": stats["cache_hits"],
-        "avg_time": round(stats["avg_time"], 2),
-        "uptime_seconds": round(time.time() - stats["start_time"], 0) if stats["start_time"] else 0,
-        "queue_waiting": stats["queue_waiting"],
-        "processing": stats["processing"],
-        "cache_stats": cache.stats()
-    }
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.post("/v1/cache/clear")
@@ -269,22 +748,36 @@ async def clear_cache():
     cache = get_cache()
     old_size = cache.stats()["size"]
     cache.clear()
+    await asyncio.to_thread(solution_store.clear)
     return {"success": True, "cleared": old_size}
 
 
+@app.post("/v1/cache/invalidate", dependencies=[Depends(verify_api_key)])
+async def invalidate_cache(
+    url: str = Query(default="https://sora.chatgpt.com"),
+    proxy: Optional[str] = Query(default=None)
+):
+    """下游发现 cookie 被拒绝时上报，删除缓存并收缩该域名的 TTL"""
+    cache = get_cache()
+    cache.invalidate(url, proxy)
+    await asyncio.to_thread(solution_store.delete, cache.key_for(url, proxy))
+    return {"success": True, "ttl": round(cache.ttl_for(url))}
+
+
+# 健康检查内容固定，启动时编码一次（负载均衡器会频繁探测）
+HEALTH_JSON = orjson.dumps({"status": "ok", "version": "2.1.0"})
+
+
 @app.get("/v1/queue")
 async def get_queue_status():
-    """队列状态"""
-    return {"waiting": stats["queue_waiting"], "processing": stats["processing"]}
+    """队列状态（最多滞后 STATS_REFRESH_INTERVAL 秒）"""
+    return Response(content=queue_json, media_type="application/json")
 
 
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    return {
-        "status": "ok",
-        "version": "2.1.0"
-    }
+    return Response(content=HEALTH_JSON, media_type="application/json")
 
 
 # ============ 管理后台 API ============
@@ -295,12 +788,17 @@ class LoginRequest(BaseModel):
 
 
 @app.post("/api/login")
-async def admin_login(req: LoginRequest):
-    """管理员登录"""
-    if admins.verify(req.username, req.password):
-        token = secrets.token_urlsafe(32)
-        admin_sessions[token] = req.username
+async def admin_login(req: LoginRequest, request: Request):
+    """管理员登录（密码哈希在线程中计算，不阻塞事件循环）"""
+    throttle_key = (req.username, request.client.host if request.client else "")
+    if login_throttle.blocked(throttle_key):
+        return ORJSONResponse({"success": False, "message": "登录失败次数过多，请稍后再试"}, status_code=429)
+    
+    if await asyncio.to_thread(admins.verify, req.username, req.password):
+        login_throttle.reset(throttle_key)
+        token = admin_sessions.create(req.username)
         return {"success": True, "token": token}
+    login_throttle.fail(throttle_key)
     return {"success": False, "message": "用户名或密码错误"}
 
 
@@ -348,26 +846,14 @@ async def delete_api_key(key_id: int):
 
 @app.get("/api/stats", dependencies=[Depends(verify_admin)])
 async def get_admin_stats():
-    """管理后台统计"""
-    cache = get_cache()
-    total = stats["total_requests"]
-    
-    return {
-        "total_requests": total,
-        "success": stats["success"],
-        "failed": stats["failed"],
-        "success_rate": f"{stats['success'] / total * 100:.1f}%" if total > 0 else "0%",
-        "cache_hits": stats["cache_hits"],
-        "avg_time": round(stats["avg_time"], 2),
-        "uptime_seconds": round(time.time() - stats["start_time"], 0) if stats["start_time"] else 0,
-        "cache_stats": cache.stats()
-    }
+    """管理后台统计：公开统计加上代理池结果"""
+    return {**build_public_stats(), "proxy_stats": proxy_pool.get_stats()}
 
 
 @app.post("/api/password", dependencies=[Depends(verify_admin)])
 async def change_admin_password(data: dict, username: str = Depends(verify_admin)):
     """修改密码"""
-    admins.change_password(username, data["password"])
+    await asyncio.to_thread(admins.change_password, username, data["password"])
     return {"success": True}
 
 
@@ -381,31 +867,47 @@ async def get_logs(limit: int = 100):
 
 @app.delete("/api/logs", dependencies=[Depends(verify_admin)])
 async def clear_logs():
-    """清空日志"""
-    request_logger.clear_logs()
+    """清空日志（等待写入线程和删除都在线程中进行，不阻塞事件循环）"""
+    await asyncio.to_thread(request_logger.clear_logs, 5)
     return {"success": True}
 
 
 # ============ 静态页面 ============
 
+class CachedStaticFiles(StaticFiles):
+    """静态资源带长期缓存头（引用处带内容版本号）"""
+    
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+        return response
+
+
+app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
+
+
 @app.get("/", response_class=HTMLResponse)
-async def index():
+async def index(request: Request):
     """首页"""
-    return FileResponse(STATIC_DIR / "index.html")
+    return INDEX_PAGE.response(request)
 
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_page():
+async def admin_page(request: Request):
     """管理后台"""
-    return FileResponse(STATIC_DIR / "admin.html")
+    return ADMIN_PAGE.response(request)
 
 
 @app.get("/login", response_class=HTMLResponse)
-async def login_page():
+async def login_page(request: Request):
     """登录页"""
-    return FileResponse(STATIC_DIR / "login.html")
+    return LOGIN_PAGE.response(request)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8005)
+    # uvloop/httptools 已安装时自动启用（Windows 上没有 uvloop，回退到 asyncio）
+    # 客户端通常会反复请求 /v1/challenge，keep-alive 延长到 30 秒以复用连接
+    # 浏览器池、缓存和管理员 session 都在进程内，只能单 worker 运行
+    uvicorn.run(app, host="0.0.0.0", port=8005, loop="auto", http="auto", timeout_keep_alive=30)
@@ -19,4 +19,5 @@ fi
 echo "✅ Xvfb 已启动，DISPLAY=$DISPLAY"
 
 # 启动服务
-exec python -m uvicorn server:app --host 0.0.0.0 --port 8005 --workers 1
+# 单 worker：浏览器池、缓存和管理员 session 都在进程内
+exec python -m uvicorn server:app --host 0.0.0.0 --port 8005 --workers 1 --loop uvloop --http httptools --timeout-keep-alive 30
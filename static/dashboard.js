@@ -0,0 +1,15 @@
+function render(d) {
+    document.getElementById('total').textContent = d.total_requests;
+    document.getElementById('rate').textContent = d.success_rate;
+    document.getElementById('cache').textContent = d.cache_stats.hit_rate;
+}
+
+if (window.EventSource) {
+    // 服务端在统计变化时推送，断线后浏览器自动重连
+    new EventSource('/v1/stats/stream').onmessage = e => render(JSON.parse(e.data));
+} else {
+    (function update() {
+        fetch('/v1/stats').then(r => r.json()).then(render).catch(() => {});
+        setTimeout(update, 5000);
+    })();
+}
@@ -0,0 +1,80 @@
+"""BrowserPool 归还/复用流程，用假页面代替 Chromium"""
+import time
+import unittest
+
+from cloudflare_solver import BrowserPool
+
+
+class FakePage:
+    def __init__(self):
+        self.url = "about:blank"
+        self.calls = []
+    
+    def get(self, url, timeout=None):
+        self.url = url
+        self.calls.append(("get", url))
+    
+    def run_js(self, script):
+        self.calls.append(("js", self.url, script))
+    
+    def run_cdp(self, cmd, **kwargs):
+        self.calls.append(("cdp", cmd, kwargs))
+    
+    def clear_cache(self, **kwargs):
+        raise AssertionError("clear_cache 在 about:blank 上清不到站点存储")
+
+
+class FakePool(BrowserPool):
+    def _launch(self, key):
+        page = FakePage()
+        page._cf_pool_key = key
+        page._cf_uses = 0
+        page._cf_state_since = time.monotonic()
+        page._cf_origins = set()
+        self._stats["created"].inc()
+        return page
+    
+    @staticmethod
+    def _is_alive(page):
+        return True
+
+
+class BrowserPoolTest(unittest.TestCase):
+    def test_released_page_is_reused(self):
+        pool = FakePool(size=1, max_idle=1)
+        page = pool.acquire()
+        page.get("https://example.com/path")
+        pool.release(page)
+        
+        # sessionStorage 在离开站点前清理
+        self.assertIn(("js", "https://example.com/path", "sessionStorage.clear();"), page.calls)
+        self.assertEqual(page.url, "about:blank")
+        self.assertIs(pool.acquire(), page)
+        self.assertEqual(pool._stats["reused"].value(), 1)
+        self.assertEqual(pool._stats["discarded"].value(), 0)
+    
+    def test_expired_state_cleared_per_origin(self):
+        pool = FakePool(size=1, max_idle=1, state_ttl=0)
+        page = pool.acquire()
+        page.get("https://example.com/")
+        pool.release(page)
+        
+        cdp = [c for c in page.calls if c[0] == "cdp"]
+        self.assertIn(("cdp", "Network.clearBrowserCookies", {}), cdp)
+        self.assertIn(("cdp", "Storage.clearDataForOrigin", {"origin": "https://example.com", "storageTypes": "all"}), cdp)
+        self.assertEqual(page._cf_origins, set())
+        self.assertIs(pool.acquire(), page)
+    
+    def test_stale_state_cleared_on_acquire(self):
+        pool = FakePool(size=1, max_idle=1)
+        page = pool.acquire()
+        page.get("https://example.com/")
+        pool.release(page)
+        
+        page.calls.clear()
+        self.assertIs(pool.acquire(state_after=time.monotonic() + 1), page)
+        self.assertIn(("cdp", "Network.clearBrowserCookies", {}), page.calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""SolutionCache 自适应 TTL 的收缩与恢复速度"""
+import time
+import unittest
+
+from cloudflare_solver import CloudflareSolution, SolutionCache
+
+URL = "https://example.com/"
+
+
+def _solution(age: float = 0.0) -> CloudflareSolution:
+    return CloudflareSolution(
+        cf_clearance="x", cookies={"cf_clearance": "x"}, user_agent="ua",
+        created_at_mono=time.monotonic() - age,
+    )
+
+
+class AdaptiveTtlTest(unittest.TestCase):
+    def test_single_invalidate_shrinks_at_most_20_percent(self):
+        cache = SolutionCache(ttl_seconds=1000)
+        cache.set(URL, _solution(age=0))
+        cache.invalidate(URL)
+        self.assertAlmostEqual(cache.ttl_for(URL), 800, delta=1)
+    
+    def test_shrink_follows_observed_age(self):
+        cache = SolutionCache(ttl_seconds=1000)
+        cache.set(URL, _solution(age=500))
+        cache.invalidate(URL)
+        self.assertAlmostEqual(cache.ttl_for(URL), 0.2 * 500 + 0.8 * 1000, delta=1)
+    
+    def test_natural_expiry_recovers(self):
+        cache = SolutionCache(ttl_seconds=1000)
+        cache.set(URL, _solution(age=0))
+        cache.invalidate(URL)
+        
+        expected = cache.ttl_for(URL)
+        for _ in range(3):
+            cache.set(URL, _solution(), ttl=-1)
+            self.assertIsNone(cache.get(URL))
+            expected = min(expected * 1.1, 1000)
+            self.assertAlmostEqual(cache.ttl_for(URL), expected, delta=1)
+        # 800 * 1.1^3 > 1000，三次自然过期后回到配置值
+        self.assertEqual(cache.ttl_for(URL), 1000)
+    
+    def test_min_ttl_floor(self):
+        cache = SolutionCache(ttl_seconds=1000)
+        for _ in range(50):
+            cache.set(URL, _solution(age=0))
+            cache.invalidate(URL)
+        self.assertEqual(cache.ttl_for(URL), SolutionCache.MIN_TTL)
+
+
+if __name__ == "__main__":
+    unittest.main()